@@ -1,6 +1,7 @@
 from himawari8py.himawari8py import get_image
 from himawari8py.himawari8py import get_images
 from himawari8py.himawari8py import get_tile
+from himawari8py.himawari8py import get_tile_bytes
 from himawari8py.himawari8py import daterange
 from himawari8py.himawari8py import latestdate
 from himawari8py.himawari8py import format_url
@@ -1,21 +1,47 @@
 #!/usr/bin/env python
 
+import io
 import os
 import requests
 import datetime
-import dateutil
-import dateutil.parser
-import itertools
-import multiprocessing
-import multiprocessing.dummy
+import functools
+import threading
+import time
+import concurrent.futures
 
 from PIL import Image
 from tqdm import tqdm
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+try:
+    import orjson as json
+except ImportError:
+    import json
+
+try:
+    import pyvips
+except (ImportError, OSError):
+    pyvips = None  # Optional, saves large images without a full canvas in memory
 
 IR_PREFIX = "FULL_24h"
 IMAGE = "D531106"
 HIMAWARI = "himawari8-dl.nict.go.jp"
 BASE_URL = f"https://{HIMAWARI}/himawari8/img"
+TIMEOUT = 30
+POOL_SIZE = 64
+MAX_THREADS = 24
+MAX_IMAGES = 3
+LATEST_TTL = 60
+DATE_PATH = "%Y/%m/%d/%H%M%S"
+LARGE_IMAGE = 8192
+
+# Tile download executor, created on first use and kept for later images
+_EXECUTOR = None
+_EXECUTOR_LOCK = threading.Lock()
+
+# Last latestdate() result as (monotonic time, date)
+_LATEST = None
 
 
 def latestdate(retries=10):
@@ -24,24 +50,21 @@ def latestdate(retries=10):
         - retries: Number of retries on requests
 
     Return: 
-        Retrieves latest available date of the last satellite image
+        Retrieves latest available date of the last satellite image,
+        cached for LATEST_TTL seconds
     """
 
-    session = requests.Session()
-    for _ in range(retries):
-        try:
-            response = session.get(f"{BASE_URL}/{IMAGE}/latest.json")
-            if response.status_code != 200:
-                continue
-            date = datetime.datetime.strptime(
-                response.json().get("date"), "%Y-%m-%d %H:%M:%S")
-            session.close()
-            return date
-        except:
-            continue
-    session.close()
-    raise Exception(
-        f"Failed to connect to server: {response.status_code}")
+    global _LATEST
+    if _LATEST is not None and time.monotonic() - _LATEST[0] < LATEST_TTL:
+        return _LATEST[1]
+
+    response = _get_session(retries).get(f"{BASE_URL}/{IMAGE}/latest.json", timeout=TIMEOUT)
+    if response.status_code != 200:
+        raise Exception(
+            f"Failed to connect to server: {response.status_code}")
+    date = datetime.datetime.fromisoformat(json.loads(response.content)["date"])
+    _LATEST = (time.monotonic(), date)
+    return date
 
 
 def get_tile(x, y, level, date, band=None, retries=10):
@@ -58,20 +81,50 @@ def get_tile(x, y, level, date, band=None, retries=10):
         Tile of image taken from planet Earth of the Japanese satellite Himawari 8
     """
 
-    url = format_url(x, y, level, date, band)
+    x, y, data = get_tile_bytes(x, y, level, date, band, retries)
+    return x, y, Image.open(io.BytesIO(data))
+
+
+def get_tile_bytes(x, y, level, date, band=None, retries=10):
+    """
+    Parameters
+        - x: horizontal position of tile
+        - y: vertical position of tile
+        - level: Tile grid size: 1, 2, 4, 8, 16, 20. IR: 1, 2, 4, 8, 10
+        - date: Image date in UTC
+        - band: Observation band: 1 - 16, default RGB
+        - retries: Number of retries on requests 
+
+    Return: 
+        Undecoded PNG data of a tile
+    """
+
+    return _fetch_tile_bytes(x, y, format_url(x, y, level, date, band), retries)
+
+
+def _fetch_tile_bytes(x, y, url, retries=10):
+    response = _get_session(retries).get(url, timeout=TIMEOUT)
+    if response.status_code != 200:
+        raise Exception(
+            f"Failed to connect to server: Response {response.status_code}")
+    return x, y, response.content
+
+
+@functools.lru_cache(maxsize=None)
+def _get_session(retries=10):
+    """
+    Parameters
+        - retries: Number of retries on requests
+
+    Return:
+        Shared keep-alive session retrying failed and throttled requests with exponential backoff
+    """
+
+    retry = Retry(total=retries, backoff_factor=0.25, status_forcelist=(429, 500, 502, 503, 504),
+                  allowed_methods=("GET",), respect_retry_after_header=True)
     session = requests.Session()
-    for _ in range(retries):
-        try:
-            response = session.get(url, stream=True)
-            if response.status_code != 200:
-                continue
-            session.close()
-            return x, y, Image.open(response.raw)
-        except:
-            continue
-    session.close()
-    raise Exception(
-        f"Failed to connect to server: Response {response.status_code}")
+    session.mount("https://", HTTPAdapter(pool_connections=POOL_SIZE, pool_maxsize=POOL_SIZE, max_retries=retry))
+    return session
 
 
 def format_url(x, y, level, date, band=None):
@@ -85,12 +138,68 @@ def format_url(x, y, level, date, band=None):
     Return:
         URL string of a tile 
     """
-    band = IMAGE if band == None or 'RGB' else f"{IR_PREFIX}/B{str(band).zfill(2)}"
-    return f"""{BASE_URL}/{band}/{level}d/550/{date.strftime("%Y/%m/%d/%H%M%S")}_{x}_{y}.png"""
+    return _tile_url(x, y, level, date.strftime(DATE_PATH), _band_prefix(band))
+
+
+def _band_prefix(band=None):
+    return IMAGE if band in (None, "RGB") else f"{IR_PREFIX}/B{str(band).zfill(2)}"
+
+
+def _tile_url(x, y, level, date_path, band_prefix):
+    return f"{BASE_URL}/{band_prefix}/{level}d/550/{date_path}_{x}_{y}.png"
+
+
+def _get_executor():
+    """
+    Return:
+        Shared thread pool executor for tile downloads, sized to the connection pool
+    """
+
+    global _EXECUTOR
+    with _EXECUTOR_LOCK:
+        if _EXECUTOR is None:
+            _EXECUTOR = concurrent.futures.ThreadPoolExecutor(
+                max_workers=POOL_SIZE, thread_name_prefix="himawari8py")
+        return _EXECUTOR
+
+
+def _check_stop(stop=None):
+    if stop is not None and stop.is_set():
+        raise concurrent.futures.CancelledError("Image download stopped")
+
+
+def _imap_unordered(fn, args, nthread=None, stop=None):
+    """
+    Parameters
+        - fn: Function to run on the shared executor
+        - args: Iterable of argument tuples
+        - nthread: Maximum number of calls in flight, default MAX_THREADS
+        - stop: Optional threading.Event, no more calls are submitted once it is set
 
+    Return:
+        Results of fn in completion order, pending calls are cancelled if iteration stops
+    """
 
-def __get_tile_thread(args):
-    return get_tile(*args)
+    nthread = MAX_THREADS if nthread is None else nthread
+    executor = _get_executor()
+    pending = set()
+    try:
+        for arg in args:
+            if len(pending) >= nthread:
+                done, pending = concurrent.futures.wait(
+                    pending, return_when=concurrent.futures.FIRST_COMPLETED)
+                for future in done:
+                    yield future.result()
+            _check_stop(stop)
+            pending.add(executor.submit(fn, *arg))
+        while pending:
+            done, pending = concurrent.futures.wait(
+                pending, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                yield future.result()
+    finally:
+        for future in pending:
+            future.cancel()
 
 
 def get_image(date=None, scale=550, level=4, band="RGB", retries=10, multithread=True, nthread=None,
@@ -103,7 +212,7 @@ def get_image(date=None, scale=550, level=4, band="RGB", retries=10, multithread
         - band: Observation band: 1 - 16, default RGB
         - retries: Number of retries on requests
         - multithread: Enable tile download multithreading
-        - nthread: Number of thread to allocate
+        - nthread: Number of tiles downloaded at once, default MAX_THREADS, at most POOL_SIZE
         - save_img: Save image option. Function will not return if True
         - img_path: Path where the image will be saved
         - img_name: Name of the image if it is saved
@@ -113,44 +222,131 @@ def get_image(date=None, scale=550, level=4, band="RGB", retries=10, multithread
         Full disk image of Earth from Himawari 8
     """
 
+    return _get_image(date, scale, level, band, retries, multithread, nthread,
+                      save_img, img_path, img_name, show_progress)
+
+
+def _get_image(date, scale, level, band, retries, multithread, nthread,
+               save_img, img_path, img_name, show_progress, stop=None):
+    # get_image, abandoned without saving once stop is set
     date = _parsedate(date, retries)
 
     path = os.path.join(img_path, img_name)
-    imgsize = (scale * level, scale * level)
-    if band == "RGB":
+    if band in (None, "RGB"):
         mode = "RGB"  # Full color
-    elif isinstance(band, int):
+    else:
         mode = "LA"  # IR
-    image = Image.new(mode, imgsize)
 
+    date_path = date.strftime(DATE_PATH)
+    band_prefix = _band_prefix(band)
+    url = functools.partial(_tile_url, level=level, date_path=date_path, band_prefix=band_prefix)
+    fetch = functools.partial(_fetch_tile_bytes, retries=retries)
+    coords = [(x, y) for x in range(level) for y in range(level)]
     if multithread:
-        pool = multiprocessing.dummy.Pool(
-            level * level if nthread is None else nthread)
-        result = list(tqdm(
-            pool.imap_unordered(__get_tile_thread,
-                                itertools.product(range(level), range(level), (level,), (date,), (band,), (retries,))),
-            total=level*level, unit="tile", desc="Downloading tiles ", disable=not show_progress))
-        pool.close()
-        pool.join()
-
-    elif not multithread:
-        result = list()
-        for x, y, l, d, b, r in tqdm(itertools.product(range(level), range(level), (level,), (date,), (band,), (retries,)),
-                                     total=level*level, unit="tile", desc="Downloading tiles ", disable=not show_progress):
-            result.append(get_tile(x, y, l, d, b, r))
-
-    for (x, y, tile) in tqdm(iterable=result, unit="tile", desc="Stitching tiles   ", disable=not show_progress):
-        box = tuple(n * scale for n in (x, y))
-        image.paste(tile.resize((scale, scale), Image.BILINEAR), box)
+        tiles = _imap_unordered(fetch, ((x, y, url(x, y)) for x, y in coords), nthread, stop)
+    else:
+        tiles = (fetch(x, y, url(x, y)) for x, y in coords)
+
+    progress = tqdm(total=level*level, unit="tile", desc="Downloading tiles ", disable=not show_progress)
+
+    # A single native size 8-bit truecolour tile is already the final RGB PNG, write it without decoding.
+    # IR, palette and alpha tiles still go through the canvas to be converted like larger images
+    if save_img and mode == "RGB" and level == 1 and scale == 550 and path.lower().endswith(".png"):
+        tiles = list(tiles)
+        (_, _, data), = tiles
+        # IHDR bit depth and colour type
+        if data[24:26] == b"\x08\x02":
+            with progress:
+                _check_stop(stop)
+                with open(path, "wb") as f:
+                    f.write(data)
+                progress.update()
+            return
+        del data
+
+    if save_img and pyvips is not None:
+        with progress:
+            _save_vips(tiles, level, scale, mode, path, progress, stop)
+        return
+
+    imgsize = (scale * level, scale * level)
+    image = Image.new(mode, imgsize)
+
+    # Stitch tiles as they arrive so only in-flight tiles are held in memory
+    with progress:
+        for (x, y, data) in tiles:
+            _check_stop(stop)
+            tile = Image.open(io.BytesIO(data))
+            box = tuple(n * scale for n in (x, y))
+            if tile.size != (scale, scale):
+                # Tiles are PNG so draft() cannot shrink the decode, reduce in steps instead
+                tile = tile.resize((scale, scale), Image.BILINEAR, reducing_gap=2.0)
+            image.paste(tile, box)
+            del tile, data
+            progress.update()
 
     if save_img:
+        _check_stop(stop)
         image.save(path)
     else:
         return image
 
 
+def _save_vips(tiles, level, scale, mode, path, progress, stop=None):
+    """
+    Parameters
+        - tiles: Iterable of (x, y, PNG data) tuples
+        - level: Tile grid size
+        - scale: Resolution of each tile in pixel
+        - mode: PIL mode of the image, RGB or LA, matched by the saved bands
+        - path: Path where the image will be saved
+        - progress: Progress bar updated for each tile, completed once the image is written
+        - stop: Optional threading.Event, nothing is written once it is set
+
+    Return:
+        Joins and saves the tiles with libvips, decoding and encoding in a streamed pipeline.
+        TIFF images wider than LARGE_IMAGE are saved as tiled pyramidal BigTIFF
+    """
+
+    grid = [None] * (level * level)
+    for n, (x, y, data) in enumerate(tiles, 1):
+        # arrayjoin expects tiles in row-major order
+        grid[y * level + x] = pyvips.Image.new_from_buffer(data, "", access="sequential")
+        # Tiles are only decoded and joined when the file is written, the last step completes the bar
+        if n < level * level:
+            progress.update()
+    image = pyvips.Image.arrayjoin(grid, across=level)
+    if image.width != scale * level:
+        # Same bilinear filter as the PIL path
+        image = image.resize(scale * level / image.width, kernel="linear")
+
+    # Same bands as pasting the tiles into a PIL canvas of this mode
+    if mode == "LA":
+        # libvips loads palette tiles as RGB(A), alpha is kept as PIL does when converting to LA
+        alpha = image.extract_band(image.bands - 1) if image.bands in (2, 4) else None
+        if image.bands >= 3:
+            # PIL's RGB to L conversion, ITU-R 601 luma in 16 bit fixed point, rounded
+            grey = image.extract_band(0, n=3).recomb([[19595 / 65536, 38470 / 65536, 7471 / 65536]])
+            image = (grey + 0.5).cast("uchar")
+        else:
+            image = image.extract_band(0)
+        image = image.bandjoin_const(255) if alpha is None else image.bandjoin(alpha)
+    else:
+        if image.bands < 3:
+            image = image.colourspace("srgb")
+        image = image.extract_band(0, n=3)
+    _check_stop(stop)
+    if image.width > LARGE_IMAGE and os.path.splitext(path)[1].lower() in (".tif", ".tiff"):
+        # Tiled pyramid so large mosaics can be read back region by region
+        image.write_to_file(path, tile=True, pyramid=True, bigtiff=True, compression="deflate")
+    else:
+        image.write_to_file(path)
+    progress.update()
+
+
 def get_images(start, finish, save_img=False, img_path="", prefix="himawari8", img_name="{prefix}_{date}.png",
-               show_progress=False, scale=550, level=4, band="RGB", retries=10, multithread=True, nthread=None):
+               show_progress=False, scale=550, level=4, band="RGB", retries=10, multithread=True, nthread=None,
+               nimage=None):
     """
     Parameters
         - start: Start date in UTC
@@ -164,15 +360,20 @@ def get_images(start, finish, save_img=False, img_path="", prefix="himawari8", i
         - level: Tile grid size: 1, 2, 4, 8, 16, 20. IR: 1, 2, 4, 8, 10
         - band: Observation band: 1 - 16, default RGB
         - retries: Number of retries on requests
-        - multithread: Enable tile download multithreading
-        - nthread: Number of thread to allocate
+        - multithread: Enable tile download multithreading and download several dates at once
+        - nthread: Number of tiles downloaded at once per image, default MAX_THREADS
+        - nimage: Number of dates downloaded at once, default MAX_IMAGES. Each holds a full image in memory
 
     Return:
         List of images between start and finish of Earth from Himawari-8
     """
 
-    dates = [date for date in daterange(start, finish)]
-    return [get_image(
+    dates = list(daterange(start, finish))
+
+    stop = threading.Event()
+
+    def _get_date_image(date):
+        return _get_image(
             scale=scale,
             level=level,
             band=band,
@@ -184,8 +385,29 @@ def get_images(start, finish, save_img=False, img_path="", prefix="himawari8", i
             img_name=img_name.replace("{prefix}", prefix).replace(
                 "{date}", date.strftime("%Y-%m-%d_%H%M%S")),
             show_progress=False,
-            date=date)
-            for date in tqdm(iterable=dates, unit="image", desc=f"Downloading {len(dates)} images", disable=not show_progress)]
+            date=date,
+            stop=stop)
+
+    progress = dict(unit="image", desc=f"Downloading {len(dates)} images", disable=not show_progress)
+    nimage = MAX_IMAGES if nimage is None else nimage
+    if not multithread or nimage == 1:
+        return [_get_date_image(date) for date in tqdm(iterable=dates, **progress)]
+
+    # Overlap consecutive dates, tile requests stay bounded by the shared tile executor
+    executor = concurrent.futures.ThreadPoolExecutor(max_workers=nimage)
+    futures = {executor.submit(_get_date_image, date): i for i, date in enumerate(dates)}
+    images = [None] * len(dates)
+    try:
+        for future in tqdm(iterable=concurrent.futures.as_completed(futures), total=len(futures), **progress):
+            images[futures[future]] = future.result()
+    except BaseException:
+        # Stop at the first failed date: abandon running dates and wait for them,
+        # so nothing is written after the error is raised
+        stop.set()
+        executor.shutdown(wait=True, cancel_futures=True)
+        raise
+    executor.shutdown()
+    return images
 
 
 def daterange(start, finish, increment=10):
@@ -204,18 +426,32 @@ def daterange(start, finish, increment=10):
 
     if finish < start:
         raise Exception(
-            f"End date {start} should be less than start date {finish}")
+            f"Start date {start} should be less than end date {finish}")
 
     base = datetime.datetime(
         start.year, start.month, start.day, start.hour, round(start.minute/10)*10, 0, 0)
     total_minutes = (finish - start).total_seconds()/60
-    for i in range(int(total_minutes/increment)):
-        yield (base + datetime.timedelta(minutes=i * increment))
+    n_intervals = int(total_minutes/increment)
+    step = datetime.timedelta(minutes=increment)
+    date = base
+    for _ in range(n_intervals):
+        yield date
+        date += step
+
+
+@functools.lru_cache(maxsize=16)
+def _parse_str(date):
+    try:
+        return datetime.datetime.fromisoformat(date)
+    except ValueError:
+        # Free-form dates only, dateutil is much slower than fromisoformat
+        import dateutil.parser
+        return dateutil.parser.parse(date)
 
 
 def _parsedate(date, retries=10):
     if isinstance(date, str):
-        date = dateutil.parser.parse(date)
+        date = _parse_str(date)
     elif isinstance(date, datetime.datetime):
         date = date
     elif date is None: